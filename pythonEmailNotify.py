@@ -1,7 +1,7 @@
 import smtplib
 from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import traceback
+from html import escape
 
 class EmailSender:
     def __init__(self, smtp_server, port, login, password, default_recipient=None):
@@ -18,6 +18,74 @@ class EmailSender:
         self.login = login
         self.password = password
         self.default_recipient = default_recipient
+        self._smtp = None
+
+    def __enter__(self):
+        """
+        Open the shared SMTP connection up front and close it on exit.
+        If it cannot be opened here, the first send retries.
+        """
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def _connect(self):
+        server = smtplib.SMTP(self.smtp_server, self.port)
+        try:
+            server.starttls()
+            server.login(self.login, self.password)
+        except Exception:
+            server.close()
+            raise
+        self._smtp = server
+
+    def connect(self):
+        """
+        Open the shared SMTP connection now (no-op if already open), e.g. to warm it
+        up in the background before entering the with-block.
+        :return: True if a shared connection is open.
+        """
+        if self._smtp is None:
+            try:
+                self._connect()
+            except Exception as e:
+                print(f"Failed to open SMTP connection: {e}")
+        return self._smtp is not None
+
+    def _session(self):
+        """
+        Return the shared, authenticated SMTP connection, opening it on first use.
+        A reused connection is checked with NOOP and reopened if the server dropped it.
+        """
+        if self._smtp is not None:
+            try:
+                self._smtp.noop()
+            except (smtplib.SMTPServerDisconnected, OSError):
+                self.close()
+        if self._smtp is None:
+            self._connect()
+        return self._smtp
+
+    def close(self):
+        """
+        Close the shared SMTP connection, if one is open.
+        """
+        server, self._smtp = self._smtp, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
 
     def sendEmail(self, subject, body, recipient=None, html=False):
         """
@@ -32,19 +100,20 @@ class EmailSender:
 
         recipient = recipient or self.default_recipient
 
-        # Create email message
-        msg = MIMEMultipart()
+        # Create email message (single body, so no multipart wrapper; us-ascii/7bit unless non-ASCII)
+        msg = MIMEText(body, 'html' if html else 'plain')
         msg['From'] = self.login
         msg['To'] = recipient
         msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'html' if html else 'plain'))
 
         try:
-            # Send email
-            with smtplib.SMTP(self.smtp_server, self.port) as server:
-                server.starttls()
-                server.login(self.login, self.password)
-                server.send_message(msg)
+            # Send email over the persistent session (TLS + login only on first use)
+            try:
+                self._session().send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # Connection dropped mid-send: discard it and reopen once
+                self.close()
+                self._session().send_message(msg)
             print(f"Email sent successfully to {recipient}.")
         except Exception as e:
             print(f"Failed to send email: {e}")
@@ -56,11 +125,13 @@ class EmailSender:
         :param recipient: Recipient email address. Uses default_recipient if None.
         """
         subject = "Exception Occurred in Script"
+        # Format the exception's own traceback (not whatever sys.exc_info() holds now)
+        tb = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
         body = f"""
         <h1>Exception Report</h1>
         <p><strong>Type:</strong> {type(exception).__name__}</p>
-        <p><strong>Message:</strong> {exception}</p>
+        <p><strong>Message:</strong> {escape(str(exception), quote=False)}</p>
         <p><strong>Traceback:</strong></p>
-        <pre>{traceback.format_exc()}</pre>
+        <pre>{escape(tb, quote=False)}</pre>
         """
         self.sendEmail(subject, body, recipient, html=True)
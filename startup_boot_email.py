@@ -4,11 +4,22 @@
 #   EMAIL_ADDRESS, EMAIL_PASSWORD, MAIN_EMAIL_ADDRESS
 
 import os
+import functools
 import socket
 import json
 import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from email.utils import formatdate
+from html import escape
+
+# orjson (optional) parses the PowerShell output bytes directly; stdlib json also accepts bytes
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 # Optional debug flag: set BOOTMAIL_DEBUG=1 in env to print status and send a probe email
 DEBUG = os.getenv("BOOTMAIL_DEBUG", "0") == "1"
@@ -16,10 +27,11 @@ DEBUG = os.getenv("BOOTMAIL_DEBUG", "0") == "1"
 def _bootmail_debug_enabled() -> bool:
     return DEBUG
 
-def _dbg(msg: str):
+def _dbg(msg: str, *args):
+    # logging-style: %-args are only formatted when DEBUG is on
     if DEBUG:
         try:
-            print(f"[BOOTMAIL] {msg}")
+            print(f"[BOOTMAIL] {msg % args if args else msg}")
         except Exception:
             pass
 
@@ -30,44 +42,128 @@ except Exception as e:
 
 PS = r"C:\\Windows\\System32\\WindowsPowerShell\\v1.0\\powershell.exe"
 
-
-def run_ps(code: str) -> str:
+# Local IPv4s rarely change between boots on the same network; cache them for a day
+IP_CACHE_PATH = os.path.join(os.getenv("TEMP") or tempfile.gettempdir(), "bootmail_ips.json")
+IP_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Error-reporting scaffold around every run_ps() snippet; built once, only {code} is substituted
+_PS_WRAPPER = (
+    "$ErrorActionPreference='Stop';"
+    "try {{"
+    "  {code} "
+    "}} catch {{"
+    "  Write-Output ('PS_ERR:' + $_.Exception.GetType().FullName + ' | ' + $_.Exception.Message);"
+    "  if ($_.InvocationInfo -and $_.InvocationInfo.PositionMessage) {{"
+    "    Write-Output ('PS_ERR_POS:' + $_.InvocationInfo.PositionMessage)"
+    "  }}"
+    "  exit 1"
+    "}}"
+)
+
+
+def run_ps_bytes(code: str) -> bytes:
     """
-    Run PowerShell code and return stdout.
+    Run PowerShell code and return stdout as stripped, undecoded bytes
+    (e.g. to hand straight to a JSON parser).
     - Forces errors to throw, captures full diagnostics to stdout prefixed with PS_ERR:
     - Returns stdout even if empty; raises RuntimeError with rich context on failure.
     """
-    WRAPPED = (
-        "$ErrorActionPreference='Stop';"
-        "try {"
-        f"  {code} "
-        "} catch {"
-        "  Write-Output ('PS_ERR:' + $_.Exception.GetType().FullName + ' | ' + $_.Exception.Message);"
-        "  if ($_.InvocationInfo -and $_.InvocationInfo.PositionMessage) {"
-        "    Write-Output ('PS_ERR_POS:' + $_.InvocationInfo.PositionMessage)"
-        "  }"
-        "  exit 1"
-        "}"
-    )
     p = subprocess.run(
-        [PS, "-NoProfile", "-ExecutionPolicy", "Bypass", "-Command", WRAPPED],
-        capture_output=True, text=True, encoding="utf-8", errors="replace"
+        [PS, "-NoLogo", "-NoProfile", "-NonInteractive", "-ExecutionPolicy", "Bypass", "-Command",
+         _PS_WRAPPER.format(code=code)],
+        capture_output=True
     )
-    out = (p.stdout or "").strip()
+    out = (p.stdout or b"").strip()
     if p.returncode != 0:
-        # include stderr too, in case PS wrote anything there
-        err = (p.stderr or "").strip()
-        raise RuntimeError(f"PowerShell failed\nCODE:\n{code}\nSTDOUT:\n{out}\nSTDERR:\n{err}")
+        # include stderr too, in case PS wrote anything there (e.g. parse errors, which bypass the catch)
+        # stderr is only decoded on failure
+        err = (p.stderr or b"").decode("utf-8", "replace").strip()
+        raise RuntimeError(
+            f"PowerShell failed\nCODE:\n{code}\nSTDOUT:\n{out.decode('utf-8', 'replace')}\nSTDERR:\n{err}"
+        )
     return out
 
 
+def run_ps(code: str) -> str:
+    """
+    Run PowerShell code and return stdout as text (see run_ps_bytes).
+    """
+    # Read raw bytes and decode once
+    return run_ps_bytes(code).decode("utf-8", "replace")
+
+
 def iso_utc_now() -> str:
     return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
 
 
-def get_boot_time_iso() -> str:
-    ps = "(Get-CimInstance Win32_OperatingSystem).LastBootUpTime.ToUniversalTime().ToString('o')"
-    return run_ps(ps)
+def gather_all_ps(hours_before: int = 6, limit: int = 10, include_ips: bool = True) -> dict:
+    """
+    Collect boot time, local IPv4s, newest crash marker and recent Critical/Error
+    events in ONE PowerShell session (one powershell.exe launch instead of four).
+    Returns the parsed JSON document: {Boot, IPs, Crash, Errors}.
+    - Crash IDs: 41 (Kernel-Power), 6008 (Unexpected Shutdown), 1001 (BugCheck)
+    - If a crash exists, Errors are the newest `limit` in [crash-hrs, crash]; else the newest overall.
+    - IP/event sections fail soft (empty) so the boot email still goes out.
+    - include_ips=False skips Get-NetIPAddress (IPs come back empty), e.g. on an IP cache hit.
+    Always emits TimeCreated in ISO-8601 UTC.
+    """
+    ps = (
+        "$sel = @{n='TimeCreated';e={$_.TimeCreated.ToUniversalTime().ToString('o')}},'Id','ProviderName','Message'; "
+        "$boot = (Get-CimInstance Win32_OperatingSystem).LastBootUpTime.ToUniversalTime().ToString('o'); "
+        "$ips = @(); "
+    )
+    if include_ips:
+        ps += (
+            "try { "
+            "  $ips = @(Get-NetIPAddress -AddressFamily IPv4 "
+            "  | Where-Object { $_.InterfaceOperationalStatus -eq 'Up' "
+            "   -and $_.IPAddress -notlike '169.*' "
+            "   -and $_.IPAddress -ne '127.0.0.1' } "
+            "  | Select-Object -ExpandProperty IPAddress) "
+            "} catch { $ips = @() }; "
+        )
+    ps += (
+        # Get-WinEvent renders Message for every record it returns, so each query is
+        # narrowed in the event-log filter itself and capped at what we actually use
+        "$crash = $null; "
+        "try { "
+        "  $crash = Get-WinEvent -FilterHashtable @{LogName='System'; Id=41,6008,1001} -MaxEvents 1 -ErrorAction SilentlyContinue "
+        "} catch { $crash = $null }; "
+        "$errs = @(); "
+        "try { "
+        "  if ($crash) { "
+        # ref time stays a DateTime inside PS: no ISO round-trip/parse needed
+        "    $t = $crash.TimeCreated; "
+        f"    $start = $t.AddHours(-{int(hours_before)}); "
+        # EndTime is rounded in the XPath bound; +1s keeps the crash event (sub-second $t) in the window
+        "    $errs = @(Get-WinEvent -FilterHashtable @{LogName='System'; Level=1,2; StartTime=$start; EndTime=$t.AddSeconds(1)} "
+        f"    -MaxEvents {int(limit)} -ErrorAction SilentlyContinue | Select-Object $sel) "
+        "  } else { "
+        "    $errs = @(Get-WinEvent -FilterHashtable @{LogName='System'; Level=1,2} "
+        f"    -MaxEvents {int(limit)} -ErrorAction SilentlyContinue | Select-Object $sel) "
+        "  } "
+        "} catch { $errs = @() }; "
+        "$crashOut = $null; "
+        "if ($crash) { $crashOut = $crash | Select-Object $sel }; "
+        # Array-valued keys stay JSON arrays even with one item (only pipeline input gets
+        # unrolled), and nothing nests deeper than root -> event -> field
+        "@{Boot=$boot; IPs=$ips; Crash=$crashOut; Errors=$errs} | ConvertTo-Json -Depth 2 -Compress"
+    )
+    out = run_ps_bytes(ps)
+    if not out:
+        raise RuntimeError("PowerShell returned no data")
+    try:
+        data = json_loads(out)
+    except ValueError:
+        # Not valid UTF-8 (e.g. console code page text in a message): decode leniently
+        data = json_loads(out.decode("utf-8", "replace"))
+    if not isinstance(data, dict):
+        raise RuntimeError(f"Unexpected PowerShell output: {out[:200].decode('utf-8', 'replace')}")
+    return data
+
+
+def get_boot_time_iso(data: dict) -> str:
+    return data.get("Boot") or ""
 
 
 def get_machine_name() -> str:
@@ -75,11 +171,58 @@ def get_machine_name() -> str:
     return os.getenv("COMPUTERNAME") or socket.gethostname()
 
 
-def get_local_ipv4_list() -> list[str]:
+def ip_cache_key() -> str | None:
+    """
+    Cheap network fingerprint without PowerShell: hostname + every "Interface: <local ip> --- 0x.."
+    line of `arp -a`, so an address change on any adapter invalidates the cache.
+    Returns None if arp gives nothing usable (caching is then skipped).
+    """
+    try:
+        p = subprocess.run(["arp", "-a"], capture_output=True, text=True, errors="replace", timeout=10)
+    except Exception:
+        return None
+    interfaces = sorted(
+        line.strip() for line in (p.stdout or "").splitlines() if line.strip().startswith("Interface:")
+    )
+    if not interfaces:
+        return None
+    return "|".join([socket.gethostname(), *interfaces])
+
+
+def load_cached_ips(key: str | None) -> list[str] | None:
+    """Return cached IPs if the cache matches `key` and is younger than IP_CACHE_MAX_AGE."""
+    if not key:
+        return None
+    try:
+        if time.time() - os.path.getmtime(IP_CACHE_PATH) >= IP_CACHE_MAX_AGE:
+            return None
+        with open(IP_CACHE_PATH, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("key") == key and cached.get("ips"):
+            return [str(ip) for ip in cached["ips"]]
+    except Exception:
+        pass
+    return None
+
+
+def save_cached_ips(key: str | None, ips: list[str]) -> None:
+    """Best-effort atomic write of the IP cache (temp file + os.replace)."""
+    if not key or not ips:
+        return
+    tmp = IP_CACHE_PATH + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"key": key, "ips": ips}, f)
+        os.replace(tmp, IP_CACHE_PATH)
+    except Exception:
+        pass
+
+
+def get_local_ipv4_list(data: dict, cached: list[str] | None = None) -> list[str]:
     """
     Return a list of local IPv4 addresses.
     - Start with fallback from env var MACHINE_IP (if set).
-    - Then try PowerShell detection; if it succeeds, it overwrites the fallback.
+    - Then use the cached list or PowerShell detection; if either has any, it overwrites the fallback.
     """
     # Fallback from env
     ips: list[str] = []
@@ -87,112 +230,35 @@ def get_local_ipv4_list() -> list[str]:
     if env_ip:
         ips.append(env_ip)
 
-    try:
-        ps = (
-            "Get-NetIPAddress -AddressFamily IPv4 "
-            "| Where-Object { $_.InterfaceOperationalStatus -eq 'Up' "
-            " -and $_.IPAddress -notlike '169.*' "
-            " -and $_.IPAddress -ne '127.0.0.1' } "
-            "| Select-Object -ExpandProperty IPAddress"
-        )
-        out = run_ps(ps)
-        detected = [line.strip() for line in out.splitlines() if line.strip()]
-        if detected:
-            ips = detected  # overwrite fallback if detection worked
-    except Exception:
-        # keep whatever we had from env_ip
-        pass
+    detected = cached or [str(ip).strip() for ip in (data.get("IPs") or []) if str(ip).strip()]
+    if detected:
+        ips = detected  # overwrite fallback if detection worked
 
     return ips
 
 
-def get_latest_crash_marker() -> dict | None:
+def get_latest_crash_marker(data: dict) -> dict | None:
     """
     Returns the newest crash-related event as dict or None.
     IDs: 41 (Kernel-Power), 6008 (Unexpected Shutdown), 1001 (BugCheck)
-    Ensures TimeCreated is an ISO-8601 string (UTC).
     """
-    ps = (
-        "$ids=41,6008,1001; "
-        "Get-WinEvent -FilterHashtable @{LogName='System'; Id=$ids} -MaxEvents 200 -ErrorAction SilentlyContinue | "
-        "Sort-Object TimeCreated | "
-        "Select-Object @{n='TimeCreated';e={$_.TimeCreated.ToUniversalTime().ToString('o')}},Id,ProviderName,Message | "
-        "Select-Object -Last 1 | "
-        "ConvertTo-Json -Depth 3 -Compress"
-    )
-    out = run_ps(ps)
-    if not out:
-        return None
-    try:
-        data = json.loads(out)
-        if isinstance(data, dict) and data.get("TimeCreated"):
-            return data
-    except json.JSONDecodeError:
-        pass
+    crash = data.get("Crash")
+    if isinstance(crash, dict) and crash.get("TimeCreated"):
+        return crash
     return None
 
 
-def get_recent_errors_near(time_iso: str | None, hours_before: int = 6, limit: int = 10) -> list[dict]:
+def get_recent_errors_near(data: dict) -> list[dict]:
     """
     Return recent Critical/Error (Level=1,2) events.
-    If time_iso is provided (ISO-8601), return events in [time-hrs, time].
-    Otherwise return last `limit` Critical/Error events overall.
-    Always emits TimeCreated in ISO-8601 UTC.
+    Near the crash marker if one exists, else the last few overall (see gather_all_ps).
     """
-    if time_iso:
-        # Tolerant parse for '...Z' and offsets; adjust to UTC.
-        ps = (
-            "[CultureInfo] = [System.Globalization.CultureInfo]::InvariantCulture; "
-            "[Styles] = [System.Globalization.DateTimeStyles]::AdjustToUniversal; "
-            f"$t=[datetime]::Parse('{time_iso}', [CultureInfo], [Styles]); "
-            "$start = $t.AddHours(-{hrs}); ".format(hrs=hours_before) +
-            # Pull a healthy slice and filter in pipeline (avoids EndTime quirks)
-            "Get-WinEvent -FilterHashtable @{LogName='System'; Level=1,2} -MaxEvents 1000 -ErrorAction SilentlyContinue | "
-            "Where-Object { $_.TimeCreated -le $t -and $_.TimeCreated -ge $start } | "
-            "Sort-Object TimeCreated | "
-            f"Select-Object -Last {limit} | "
-            "Select-Object @{n='TimeCreated';e={$_.TimeCreated.ToUniversalTime().ToString('o')}},Id,ProviderName,Message | "
-            "ConvertTo-Json -Depth 3 -Compress"
-        )
-    else:
-        ps = (
-            "Get-WinEvent -FilterHashtable @{LogName='System'; Level=1,2} -MaxEvents 500 -ErrorAction SilentlyContinue | "
-            "Sort-Object TimeCreated | "
-            f"Select-Object -Last {limit} | "
-            "Select-Object @{n='TimeCreated';e={$_.TimeCreated.ToUniversalTime().ToString('o')}},Id,ProviderName,Message | "
-            "ConvertTo-Json -Depth 3 -Compress"
-        )
-
-    try:
-        out = run_ps(ps)
-        if not out:
-            return []
-        data = json.loads(out)
-        if isinstance(data, dict):
-            return [data]
-        return data or []
-    except Exception:
-        # Fallback: just fetch the last N Critical/Error events so email still goes out
-        try:
-            fallback = (
-                "Get-WinEvent -FilterHashtable @{LogName='System'; Level=1,2} -MaxEvents 500 -ErrorAction SilentlyContinue | "
-                "Sort-Object TimeCreated | "
-                f"Select-Object -Last {limit} | "
-                "Select-Object @{n='TimeCreated';e={$_.TimeCreated.ToUniversalTime().ToString('o')}},Id,ProviderName,Message | "
-                "ConvertTo-Json -Depth 3 -Compress"
-            )
-            out2 = run_ps(fallback)
-            if not out2:
-                return []
-            data2 = json.loads(out2)
-            if isinstance(data2, dict):
-                return [data2]
-            return data2 or []
-        except Exception:
-            return []
+    return data.get("Errors") or []
 
 
+@functools.lru_cache(maxsize=256)
 def fmt_dt_local(iso_utc: str) -> str:
+    # Memoized: the same timestamp (e.g. crash marker + its rows) is often formatted more than once
     try:
         dt = datetime.fromisoformat(iso_utc.replace("Z", "+00:00")).astimezone()
         return dt.strftime("%Y-%m-%d %H:%M:%S %Z")
@@ -200,12 +266,27 @@ def fmt_dt_local(iso_utc: str) -> str:
         return iso_utc
 
 
+# Event messages are flattened to one line (one C-level pass instead of chained .replace())
+# and HTML-escaped, so '<'/'&' in a message can't break out of its <pre>
+_NEWLINE_TABLE = str.maketrans({"\r": " ", "\n": " "})
+
+_ROW_TMPL = (
+    "<tr>"
+    "<td>{utc}</td>"
+    "<td>{local}</td>"
+    "<td>{id}</td>"
+    "<td>{provider}</td>"
+    "<td><pre style='white-space:pre-wrap'>{msg}</pre></td>"
+    "</tr>"
+)
+
+
 def make_html(machine: str, ips: list[str], boot_iso: str, crash: dict | None, errors: list[dict]) -> str:
     ip_html = "<br>".join(ips) if ips else "(none detected)"
     boot_local = fmt_dt_local(boot_iso)
     crash_block = ""
     if crash:
-        msg = (crash.get("Message") or "").replace("\r", " ").replace("\n", " ").strip()
+        msg = escape((crash.get("Message") or "").translate(_NEWLINE_TABLE).strip(), quote=False)
         crash_block = f"""
         <h3>Most recent crash marker</h3>
         <ul>
@@ -216,18 +297,17 @@ def make_html(machine: str, ips: list[str], boot_iso: str, crash: dict | None, e
           <li><b>Message:</b><br><pre style="white-space:pre-wrap">{msg}</pre></li>
         </ul>
         """
-    rows = ""
+    parts = []
     for ev in errors:
-        msg = (ev.get("Message") or "").replace("\r", " ").replace("\n", " ").strip()
-        rows += (
-            f"<tr>"
-            f"<td>{ev.get('TimeCreated','')}</td>"
-            f"<td>{fmt_dt_local(ev.get('TimeCreated',''))}</td>"
-            f"<td>{ev.get('Id','')}</td>"
-            f"<td>{ev.get('ProviderName','')}</td>"
-            f"<td><pre style='white-space:pre-wrap'>{msg}</pre></td>"
-            f"</tr>"
-        )
+        utc = ev.get("TimeCreated") or ""
+        parts.append(_ROW_TMPL.format_map({
+            "utc": utc,
+            "local": fmt_dt_local(utc),
+            "id": ev.get("Id", ""),
+            "provider": ev.get("ProviderName", ""),
+            "msg": escape((ev.get("Message") or "").translate(_NEWLINE_TABLE).strip(), quote=False),
+        }))
+    rows = "".join(parts)
 
     return f"""
     <h2>PC Boot Notification</h2>
@@ -286,48 +366,54 @@ def main():
     if sender is None:
         raise SystemExit("EMAIL_ADDRESS/EMAIL_PASSWORD not set in environment.")
 
-    _dbg("Email sender built. From/To=" + str(getattr(sender, 'login', 'unknown')))
+    _dbg("Email sender built. From/To=%s", getattr(sender, 'login', 'unknown'))
 
     machine = get_machine_name()
-    _dbg(f"Machine={machine}")
-    ips = get_local_ipv4_list()
-    _dbg(f"IPs={ips}")
-    boot_iso = get_boot_time_iso()
-    _dbg(f"BootISO={boot_iso}")
-
-    crash = get_latest_crash_marker()
-    _dbg("Crash marker=" + (crash.get("TimeCreated") if crash else "None"))
-    # If we have a crash time, pull errors near it; else just recent errors
-    ref_time = crash.get("TimeCreated") if crash else None
-
-    # Make sure a transient WinEvent hiccup does not block the boot email
+    _dbg("Machine=%s", machine)
     try:
-        recent_errors = get_recent_errors_near(ref_time, hours_before=6, limit=10)
-        _dbg(f"Fetched {len(recent_errors)} recent error/critical events")
-    except Exception as e:
-        notify_exception(e)
-        _dbg(f"Recent-errors fetch failed: {e}")
-        recent_errors = []
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # Warm up the SMTP connection (TCP + STARTTLS + AUTH) while PowerShell runs
+            smtp_ready = pool.submit(sender.connect)
+            ip_key = ip_cache_key()
+            cached_ips = load_cached_ips(ip_key)
+            data = gather_all_ps(hours_before=6, limit=10, include_ips=cached_ips is None)
+            smtp_ready.result()
+    except Exception:
+        sender.close()
+        raise
+    ips = get_local_ipv4_list(data, cached_ips)
+    if cached_ips is None:
+        save_cached_ips(ip_key, data.get("IPs") or [])
+    _dbg("IPs=%s%s", ips, " (cached)" if cached_ips else "")
+    boot_iso = get_boot_time_iso(data)
+    _dbg("BootISO=%s", boot_iso)
+
+    crash = get_latest_crash_marker(data)
+    _dbg("Crash marker=%s", crash.get("TimeCreated") if crash else None)
+    recent_errors = get_recent_errors_near(data)
+    _dbg("Fetched %d recent error/critical events", len(recent_errors))
 
     subj = f"[BOOT] {machine} is online — {', '.join(ips) if ips else 'no IPs'}"
     html = make_html(machine, ips, boot_iso, crash, recent_errors)
     _dbg("Composed email HTML")
 
-    if DEBUG:
+    # Reuses the warmed-up connection for the probe and the boot email
+    with sender:
+        if DEBUG:
+            try:
+                sender.sendEmail(f"[BOOT-TEST] {machine}", f"Probe. IPs={ips}", html=False)
+                _dbg("Probe email sent")
+            except Exception as e:
+                _dbg("Probe email failed: %s", e)
+                notify_exception(e)
+
         try:
-            sender.sendEmail(f"[BOOT-TEST] {machine}", f"Probe. IPs={ips}", html=False)
-            _dbg("Probe email sent")
+            sender.sendEmail(subj, html, html=True)
+            _dbg("Boot email sent")
         except Exception as e:
-            _dbg(f"Probe email failed: {e}")
+            _dbg("Boot email failed: %s", e)
             notify_exception(e)
-
-    try:
-        sender.sendEmail(subj, html, html=True)
-        _dbg("Boot email sent")
-    except Exception as e:
-        _dbg(f"Boot email failed: {e}")
-        notify_exception(e)
-        raise
+            raise
 
 
 if __name__ == "__main__":